@@ -21,7 +21,7 @@ import network
 import utime
 import machine
 import uerrno as errno
-from . import gmid, isnew  # __init__.py
+from . import isnew  # __init__.py
 from .primitives import launch
 from .primitives.queue import Queue, QueueFull
 gc.collect()
@@ -30,9 +30,6 @@ from micropython import const
 WDT_CANCEL = const(-2)
 WDT_CB = const(-3)
 
-# Message ID generator. Only need one instance on client.
-getmid = gmid()
-gc.collect()
 
 # Minimal implementation of set for integers in range 0-255
 # Asynchronous version has efficient wait_empty and has_not methods
@@ -137,6 +134,10 @@ class Client:
         self._lineq = Queue(20)  # 20 entries
         self.connects = 0  # Connect count for test purposes/app access
         self._sock = None
+        # ID of next message sent: 0 initially then 1 2 ... 254 255 1 2 as
+        # per gmid(). The server clears its de-dupe list on receipt of 0.
+        self._txmid = 0
+        self._addr = None  # Cached server address
         self._acks_pend = ASetByte()  # ACKs which are expected to be received
         gc.collect()
         asyncio.create_task(self._run())
@@ -159,7 +160,8 @@ class Client:
         try:  # In case of cancellation/timeout
             # Prepend message ID to a copy of buf
             fstr = '{:02x}{}' if buf.endswith('\n') else '{:02x}{}\n'
-            mid = next(getmid)
+            mid = self._txmid
+            self._txmid = mid + 1 if mid < 255 else 1
             self._acks_pend.add(mid)
             buf = fstr.format(mid, buf)
             await self._write(buf)
@@ -273,15 +275,27 @@ class Client:
             self._sock = socket.socket()
             self._evfail.clear()
             try:
-                serv = socket.getaddrinfo(self._server, self._port)[
-                    0][-1]  # server read
+                # getaddrinfo blocks the scheduler: resolve once and reuse
+                # the address on reconnection.
+                if self._addr is None:
+                    self._addr = socket.getaddrinfo(self._server, self._port)[
+                        0][-1]  # server read
                 # If server is down OSError e.args[0] = 111 ECONNREFUSED
-                self._sock.connect(serv)
+                self._sock.connect(self._addr)
             except OSError as e:
                 if e.args[0] in (errno.ECONNABORTED, errno.ECONNRESET, errno.ECONNREFUSED):
                     if init:
                         await self.bad_server()
+                else:  # Host unreachable or DNS failure: resolve again
+                    self._addr = None
             else:
+                # Small frames, each ACK'd: disable Nagle's algorithm where
+                # the port supports it. Failure is harmless.
+                if hasattr(socket, 'IPPROTO_TCP') and hasattr(socket, 'TCP_NODELAY'):
+                    try:
+                        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    except OSError:
+                        pass
                 self._sock.setblocking(False)
                 # Start reading before server can send: can't send until it
                 # gets ID.
@@ -398,6 +412,7 @@ class Client:
     async def _send(self, d):  # Write a line to socket.
         async with self._s_lock:
             start = utime.ticks_ms()
+            d = memoryview(d)  # Partial writes: avoid copying the remainder
             while d:
                 try:
                     ns = self._sock.send(d)  # OSError if client closes socket
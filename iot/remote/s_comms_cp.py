@@ -54,6 +54,9 @@ class App:
         data = None
         while True:
             await App.trig_send.wait()
+            # Let reader process any queued lines: bursts coalesce into a
+            # single write of the latest data.
+            await asyncio.sleep(0)
             App.trig_send.clear()
             data = App.data
             await self.conn.write(json.dumps(data), False)  # Reduce latency
@@ -15,120 +15,129 @@
 # Under CPython requires CPython 3.8 or later.
 
 import sys
-from . import gmid, isnew  # __init__.py
+from . import isnew  # __init__.py
 
 upython = sys.implementation.name == 'micropython'
 if upython:
     import usocket as socket
     import uasyncio as asyncio
-    import utime as time
-    import uselect as select
-    import uerrno as errno
+    from ucollections import deque
 else:
-    import socket
     import asyncio
-    import time
-    import select
-    import errno
-
-Lock = asyncio.Lock
-
-TIM_TINY = 0.05  # Short delay avoids 100% CPU utilisation in busy-wait loops
-
-# Read the node ID. There isn't yet a Connection instance.
-# CPython does not have socket.readline. Return 1st string received
-# which starts with client_id.
-
-# Note re OSError: did detect errno.EWOULDBLOCK. Not supported in MicroPython.
-# In cpython EWOULDBLOCK == EAGAIN == 11.
-async def _readid(s, to_secs):
-    data = ''
-    start = time.time()
-    while True:
+    from collections import deque
+    import os
+    if os.environ.get('IOT_UVLOOP') == '1':  # Opt in to uvloop if installed
         try:
-            d = s.recv(4096).decode()
-        except OSError as e:
-            err = e.args[0]
-            if err == errno.EAGAIN:
-                if (time.time() - start) > to_secs:
-                    raise OSError  # Timeout waiting for data
-                else:
-                    # Waiting for data from client. Limit CPU overhead. 
-                    await asyncio.sleep(TIM_TINY)
-            else:
-                raise OSError  # Reset by peer 104
-        else:
-            if d == '':
-                raise OSError  # Reset by peer or t/o
-            data = '{}{}'.format(data, d)
-            if data.find('\n') != -1:  # >= one line
-                return data
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+
+# Default maximum no. of received lines buffered per client (run() maxlines
+# arg). If an application fails to read, further lines are discarded without
+# an ACK. The client retransmits qos messages until there is space: messages
+# sent with qos=False are lost.
+MAXLINES = 100
+
+# High-water mark of a Connection's transmit buffer (bytes). Writers pause
+# while it is exceeded until ._writer has sent the buffered data.
+WBUF_MAX = 2048
+
+# All 256 ACK frames ('00\n' to 'ff\n') concatenated: a 3-byte slice is the
+# ACK for a message ID. Avoids formatting an ACK for each received message.
+_ACKS = b''.join(b'%02x\n' % mid for mid in range(256))
+
+# Close a stream. Under MicroPython StreamWriter.close() is a no-op: the socket
+# is closed by the asynchronous .wait_closed(). Under CPython .close() fails if
+# the event loop has terminated (e.g. .close_all() after asyncio.run()).
+def _sclose(swriter):
+    try:
+        swriter.close()
+    except RuntimeError:  # CPython: event loop is closed.
+        pass
+    if upython:
+        swriter.s.close()
 
 
 # API: application calls server.run()
 # Allow 2 extra connections. This is to cater for error conditions like
 # duplicate or unexpected clients. Accept the connection and have the
 # Connection class produce a meaningful error message.
-async def run(expected, verbose=False, port=8123, timeout=2000):
-    addr = socket.getaddrinfo('0.0.0.0', port, 0, socket.SOCK_STREAM)[0][-1]
-    s_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # server socket
-    s_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s_sock.bind(addr)
-    s_sock.listen(len(expected) + 2)
-    verbose and print('Awaiting connection.', port)
-    poller = select.poll()
-    poller.register(s_sock, select.POLLIN)
+async def run(expected, verbose=False, port=8123, timeout=2000,
+              maxlines=MAXLINES):
     to_secs = timeout / 1000  # ms -> secs
-    while True:
-        res = poller.poll(1)  # 1ms block
-        if res:  # Only s_sock is polled
-            c_sock, _ = s_sock.accept()  # get client socket
-            c_sock.setblocking(False)
-            try:
-                data = await _readid(c_sock, to_secs)
-            except OSError:
-                c_sock.close()
-            else:
-                Connection.go(to_secs, data, verbose, c_sock, s_sock,
-                              expected)
-        await asyncio.sleep(0.2)
+    Connection._expected.update(expected)
+
+    # Runs on each incoming connection. Read the node ID: there isn't yet a
+    # Connection instance.
+    async def accept(sreader, swriter):
+        # Frames are small and each message is ACK'd: disable Nagle's algorithm.
+        # CPython streams do this by default. Ports lacking the option ignore it.
+        if upython and hasattr(socket, 'TCP_NODELAY'):
+            swriter.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            data = await asyncio.wait_for(sreader.readline(), to_secs)
+            client_id = data[:-1].decode()
+        # ValueError: CPython line exceeds StreamReader limit, or bad UTF8.
+        except (OSError, ValueError, asyncio.TimeoutError):
+            data = b''
+        if data.endswith(b'\n'):
+            Connection.go(to_secs, client_id, verbose, sreader, swriter,
+                          maxlines)
+        else:  # Incomplete line: peer closed or timed out
+            _sclose(swriter)
+
+    server = await asyncio.start_server(accept, '0.0.0.0', port,
+                                        backlog=len(expected) + 2)
+    Connection._server = server
+    verbose and print('Awaiting connection.', port)
+    try:
+        await server.wait_closed()
+    finally:  # Close connections while the event loop is still running.
+        Connection.close_all()  # Runs when asyncio.run() cancels this task.
 
 
 # A Connection persists even if client dies (minimise object creation).
 # If client dies Connection is closed: ._close() flags this state by closing its
-# socket and setting .sock to None (.status() == False).
+# stream and setting ._swriter to None (.status() == False).
 class Connection:
     _conns = {}  # index: client_id. value: Connection instance
     _expected = set()  # Expected client_id's
-    _server_sock = None
+    _server = None
+    _evnew = None  # Set when a new client connects. Created on demand.
 
     @classmethod
-    def go(cls, to_secs, data, verbose, c_sock, s_sock, expected):
-        client_id, init_str = data.split('\n', 1)
+    def go(cls, to_secs, client_id, verbose, sreader, swriter, maxlines):
         verbose and print('Got connection from client', client_id)
-        if cls._server_sock is None:  # 1st invocation
-            cls._server_sock = s_sock
-            cls._expected.update(expected)
-        if client_id in cls._conns:  # Old client, new socket
-            if cls._conns[client_id].status():
-                print('Duplicate client {} ignored.'.format(client_id))
-                c_sock.close()
-            else:  # Reconnect after failure
-                cls._conns[client_id]._reconnect(c_sock)
-        else: # New client: instantiate Connection
-            Connection(to_secs, c_sock, client_id, init_str, verbose)
+        conn = cls._conns.get(client_id)
+        if conn is None:  # New client: instantiate Connection
+            Connection(to_secs, sreader, swriter, client_id, verbose,
+                       maxlines)
+        elif conn.status():  # Old client already has a working connection
+            print('Duplicate client {} ignored.'.format(client_id))
+            _sclose(swriter)
+        else:  # Reconnect after failure
+            conn._reconnect(sreader, swriter)
+
+    # Pause until a new client connects.
+    @classmethod
+    async def _await_new(cls):
+        if cls._evnew is None:
+            cls._evnew = asyncio.Event()
+        ev = cls._evnew  # .close_all() may replace it
+        await ev.wait()
+        ev.clear()
 
     # Server-side app waits for a working connection
     @classmethod
     async def client_conn(cls, client_id):
-        while True:
-            if client_id in cls._conns:
-                c = cls._conns[client_id]
-                # await c 
-                # works but under CPython produces runtime warnings. So do:
-                await c._status_coro()
-                return c
-            await asyncio.sleep(0.5)
+        while client_id not in cls._conns:
+            await cls._await_new()
+        c = cls._conns[client_id]
+        # await c
+        # works but under CPython produces runtime warnings. So do:
+        await c._status_coro()
+        return c
 
     # App waits for all expected clients to connect.
     @classmethod
@@ -138,25 +147,40 @@ class Connection:
             conn = await client_conn(client_id)
         if peers is None:  # Wait for all expected clients
             while cls._expected:
-                await asyncio.sleep(0.5)
+                await cls._await_new()
         else:
-            while not set(cls._conns.keys()).issuperset(peers):
-                await asyncio.sleep(0.5)
+            while not all(p in cls._conns for p in peers):
+                await cls._await_new()
         return conn
 
+    # Close all connections and the server, cancelling each Connection's
+    # tasks so that run() may be called again with fresh state.
     @classmethod
     def close_all(cls):
         for conn in cls._conns.values():
             conn._close('Connection {} closed by application'.format(conn._cl_id))
-        if cls._server_sock is not None:
-            cls._server_sock.close()
-
-    def __init__(self, to_secs, c_sock, client_id, init_str, verbose):
+            for task in conn._tasks:
+                task.cancel()
+        cls._conns.clear()
+        cls._expected.clear()
+        if cls._server is not None:
+            cls._server.close()
+            cls._server = None
+        if cls._evnew is not None:
+            # Waiting tasks wake and re-check state using a new Event.
+            cls._evnew.set()
+            cls._evnew = None
+
+    def __init__(self, to_secs, sreader, swriter, client_id, verbose,
+                 maxlines=MAXLINES):
         self._to_secs = to_secs
-        self._tim_short = self._to_secs / 10
-        self._tim_short_ms = int(self._to_secs * 100)  # MicroPython only!
         self._tim_ka = self._to_secs / 4  # Keepalive interval
-        self._sock = c_sock  # Socket
+        self._sreader = sreader  # Streams
+        self._swriter = swriter
+        self._up = True  # Status: maintained with ._swriter. Internal code
+        # reads it directly rather than calling .status()
+        self._evok = asyncio.Event()  # Set while link is up
+        self._evok.set()
         self._cl_id = client_id
         self._verbose = verbose
         self._newlist = bytearray(32)  # Per-client de-dupe list
@@ -167,39 +191,54 @@ class Connection:
         except KeyError:
             print('Unknown client {} has connected. Expected {}.'.format(
                 client_id, Connection._expected))
+        if Connection._evnew is not None:
+            Connection._evnew.set()  # Wake any task awaiting this client
 
-        self._getmid = gmid()  # Message ID generator
-        # ._wr_pause set after initial or subsequent client connection. Cleared
+        # ID of next message sent: 0 initially then 1 2 ... 254 255 1 2 as
+        # per gmid(). The client clears its de-dupe list on receipt of 0.
+        self._txmid = 0
+        # ._evwr cleared after initial or subsequent client connection. Set
         # after 1st keepalive received. We delay sending anything other than
-        # keepalives while ._wr_pause is set
-        self._wr_pause = True
+        # keepalives while ._evwr is clear
+        self._evwr = asyncio.Event()
         self._await_client = True  # Waiting for 1st received line.
-        self._wlock = Lock()  # Write lock
-        self._lines = []  # Buffer of received lines
+        self._wbuf = bytearray()  # Data awaiting transmission by ._writer
+        self._evtx = asyncio.Event()  # Set when data is added to ._wbuf
+        self._evflush = asyncio.Event()  # Set when ._wbuf has been sent
+        self._maxlines = maxlines
+        self._lines = deque((), maxlines)  # Buffer of received lines
+        self._evline = asyncio.Event()  # Set when a line is received
         self._acks_pend = set()  # ACKs which are expected to be received
-        asyncio.create_task(self._read(init_str))
-        asyncio.create_task(self._keepalive())
-
-    def _reconnect(self, c_sock):
-        self._sock = c_sock
-        self._wr_pause = True
+        self._evack = asyncio.Event()  # Set on ACK receipt or outage
+        self._tasks = (asyncio.create_task(self._read()),
+                       asyncio.create_task(self._writer()))
+
+    def _reconnect(self, sreader, swriter):
+        self._sreader = sreader
+        self._swriter = swriter
+        self._up = True
+        self._evok.set()
         self._await_client = True
 
-    # Have received 1st data packet from client. Launched by ._read
+    # Have received 1st data packet from client. Launched by ._read. The
+    # client starts its reader before sending its ID, so a short delay
+    # suffices to let the ESP get out of bed.
     async def _client_active(self):
-        await asyncio.sleep(0.2)  # Let ESP get out of bed.
-        self._wr_pause = False
+        await asyncio.sleep(0.05)
+        if self._up:
+            self._evwr.set()
 
     def status(self):
-        return self._sock is not None
+        return self._up
 
     __call__ = status
 
-    def __await__(self):
-        if upython:
-            while not self():
-                yield from asyncio.sleep_ms(self._tim_short_ms)
-        else: 
+    # Choose the implementation once, when the class is defined.
+    if upython:
+        def __await__(self):
+            yield from self._evok.wait()
+    else:
+        def __await__(self):
             # CPython: Meet requirement for generator in __await__
             # https://github.com/python/asyncio/issues/451
             yield from self._status_coro().__await__()
@@ -207,107 +246,86 @@ class Connection:
     __iter__ = __await__  # MicroPython compatibility.
 
     async def _status_coro(self):
-        while not self():
-            await asyncio.sleep(self._tim_short)
+        await self._evok.wait()
 
     async def readline(self):
-        l = self._readline()
-        if l is not None:
-            return l
-        # Must wait for data
         while True:
-            if not self():  # Outage
+            l = self._readline()
+            if l is not None:
+                return l
+            # Must wait for data
+            if not self._up:  # Outage
                 self._verbose and print('Client:', self._cl_id, 'awaiting connection')
                 await self._status_coro()
                 self._verbose and print('Client:', self._cl_id, 'connected')
-            while self():
-                l = self._readline()
-                if l is not None:
-                    return l
-                await asyncio.sleep(TIM_TINY)  # Limit CPU utilisation
+            else:
+                await self._evline.wait()  # Pause until ._read gets a line
+                self._evline.clear()
 
-    # Immediate return. If a non-duplicate line is ready return it.
+    # Immediate return. If a line is ready return it. Dupes were discarded
+    # on receipt.
     def _readline(self):
-        while self._lines:
-            line = self._lines.pop(0)
-            # Discard dupes: get message ID
-            mid = int(line[0:2], 16)
-            # mid == 0 : client has power cycled. Clear list of mid's.
-            if not mid:
-                isnew(-1, self._newlist)
-            if isnew(mid, self._newlist):
-                return '{}{}'.format(line[2:], '\n')
+        if self._lines:
+            return self._lines.popleft()[2:].decode()  # Retains trailing \n
 
-    async def _read(self, istr):
+    async def _read(self):
         while True:
             # Start (or restart after outage). Do this promptly.
-            # Fast version of await self._status_coro()
-            while self._sock is None:
-                await asyncio.sleep(TIM_TINY)
+            await self._status_coro()
             self.nconns += 1  # For test scripts
-            start = time.time()
-            while self():
+            while self._up:
                 try:
-                    d = self._sock.recv(4096)  # bytes object
-                    #print('TEST', d)
-                except OSError as e:
-                    err = e.args[0]
-                    if err == errno.EAGAIN:  # Would block: try later
-                        if time.time() - start > self._to_secs:
-                            self._close('_read timeout')  # Unless it timed out.
-                        else:
-                            # Waiting for data from client. Limit CPU overhead.
-                            await asyncio.sleep(TIM_TINY)
-                    else:
-                        self._close('_read reset by peer 104')
+                    d = await asyncio.wait_for(self._sreader.readline(),
+                                               self._to_secs)
+                except asyncio.TimeoutError:
+                    self._close('_read timeout')
+                except OSError:
+                    self._close('_read reset by peer 104')
+                except ValueError:  # CPython: line exceeds StreamReader limit
+                    self._close('_read line too long')
                 else:
-                    start = time.time()  # Something was received
+                    # Something was received
                     if self._await_client:  # 1st item after (re)start
                         self._await_client = False  # Enable write after delay
                         asyncio.create_task(self._client_active())
-                    if d == b'':  # Reset by peer
+                    if not d.endswith(b'\n'):  # Reset by peer
                         self._close('_read reset by peer')
-                        continue
-                    d = d.lstrip(b'\n')  # Discard leading KA's
-                    if d == b'':  # Only KA's
-                        continue
-
-                    istr += d.decode()  # Add to any partial message
-                    # Strings from this point
-                    l = istr.split('\n')
-                    istr = l.pop()  # '' unless partial line
-                    self._process_str(l)
-
-    # Given a list of received lines remove any ka's from middle. Split into
-    # messages and ACKs. Put messages into ._lines and remove ACKs from
-    # ._acks_pend. Note messages in ._lines have no trailing \n.
-    def _process_str(self, l):
-        l = [x for x in l if x]  # Discard ka's
-        self._acks_pend -= {int(x, 16) for x in l if len(x) == 2}
-        lines = [x for x in l if len(x) != 2]  # Lines received
-        if lines:
-            self._lines.extend(lines)
-            for line in lines:
-                asyncio.create_task(self._sendack(int(line[0:2], 16)))
-
-    async def _sendack(self, mid):
-        async with self._wlock:
-            await self._send('{:02x}\n'.format(mid))
-
-    async def _keepalive(self):
-        while True:
-            await self._vwrite(None)
-            await asyncio.sleep(self._tim_ka)
+                    elif len(d) > 1:  # Discard KA's
+                        self._process_line(d)
+
+    # Given a received line (bytes including trailing \n) which is either a
+    # message or an ACK, put a new message into ._lines or remove an ACK from
+    # ._acks_pend. The message ID is parsed once, here. Messages are decoded
+    # only when read by the application.
+    def _process_line(self, line):
+        mid = int(line[0:2], 16)
+        if len(line) == 3:  # ACK
+            self._acks_pend.discard(mid)
+            self._evack.set()
+        elif len(self._lines) < self._maxlines:
+            # mid == 0 : client has power cycled. Clear list of mid's.
+            if not mid:
+                isnew(-1, self._newlist)
+            if isnew(mid, self._newlist):  # Discard dupes
+                self._lines.append(line)
+                self._evline.set()
+            self._sendack(mid)  # ACK dupes too: original ACK may have been lost
+
+    def _sendack(self, mid):
+        if self._up:
+            self._queue(_ACKS[mid * 3: mid * 3 + 3])
 
     async def write(self, line, qos=True, wait=True):
         if qos and wait:
             while self._acks_pend:
-                await asyncio.sleep(TIM_TINY)
+                await self._evack.wait()  # Pause until an ACK is received
+                self._evack.clear()
         fstr =  '{:02x}{}' if line.endswith('\n') else '{:02x}{}\n'
-        mid = next(self._getmid)
+        mid = self._txmid
+        self._txmid = mid + 1 if mid < 255 else 1
         self._acks_pend.add(mid)
         # ACK will be removed from ._acks_pend by ._read
-        line = fstr.format(mid, line)  # Local copy
+        line = fstr.format(mid, line).encode('utf8')  # Encode once only
         await self._vwrite(line)  # Write verbatim
         if not qos:  # Don't care about ACK. All done.
             return
@@ -323,72 +341,87 @@ class Connection:
     # When ._read receives an ACK it is discarded from ._acks_pend. Wait for
     # this to occur (or an outage to start). Currently use system timeout.
     async def _waitack(self, mid):
-        tstart = time.time()  # Wait for ACK
-        while mid in self._acks_pend:
-            await asyncio.sleep(TIM_TINY)
-            if not self() or ((time.time() - tstart) > self._to_secs):
-                self._verbose and print('waitack timeout', mid)
-                return False  # Outage or ACK not received in time
+        try:
+            await asyncio.wait_for(self._has_not(mid), self._to_secs)
+        except asyncio.TimeoutError:
+            pass
+        if mid in self._acks_pend:
+            self._verbose and print('waitack timeout', mid)
+            return False  # Outage or ACK not received in time
         return True
 
+    async def _has_not(self, mid):  # Pause until ACK received or outage
+        while mid in self._acks_pend and self._up:
+            await self._evack.wait()
+            self._evack.clear()
+
     # Verbatim write: add no message ID.
     async def _vwrite(self, line):
-        ok = False
-        while not ok:
-            if self._verbose and not self():
+        while True:
+            if self._verbose and not self._up:
                 print('Writer Client:', self._cl_id, 'awaiting OK status')
             await self._status_coro()
-            if line is None:
-                line = '\n'  # Keepalive. Send now: don't care about loss
-            else:
-                # Aawait client ready after initial or subsequent connection
-                while self._wr_pause:
-                    await asyncio.sleep(self._tim_short)
+            # Await client ready after initial or subsequent connection
+            await self._evwr.wait()
+            if len(self._wbuf) >= WBUF_MAX:  # Backpressure: await ._writer
+                await self._evflush.wait()
+                self._evflush.clear()
+            elif self._up:
+                break
+        self._queue(line)
 
-            async with self._wlock:  # >1 writing task?
-                ok = await self._send(line)  # Fail clears status
+    # Queue an encoded frame for transmission.
+    def _queue(self, line):
+        self._wbuf.extend(line)
+        self._evtx.set()
 
-    # Send a string. Return True on apparent success, False on failure.
+    # Send all queued data. Frames queued in one scheduler pass are coalesced
+    # into a single write. Queued data is discarded on an outage. A keepalive
+    # is sent on connection and whenever nothing has been sent for ._tim_ka.
+    async def _writer(self):
+        while True:
+            await self._status_coro()  # Wait for (re)connection
+            self._queue(b'\n')
+            while self._up:
+                try:
+                    await asyncio.wait_for(self._evtx.wait(), self._tim_ka)
+                except asyncio.TimeoutError:
+                    self._queue(b'\n')  # Don't care about loss
+                self._evtx.clear()
+                d = self._wbuf
+                self._wbuf = bytearray()
+                await self._send(d)
+                self._evflush.set()  # Release any paused writers
+
+    # Send bytes. Return True on apparent success, False on failure.
     async def _send(self, d):
-        if not self():
+        if not self._up:
             return False
-        d = d.encode('utf8')  # Socket requires bytes
-        start = time.time()
-        while d:
-            try:
-                ns = self._sock.send(d)  # Raise OSError if client fails
-            except OSError as e:
-                err = e.args[0]
-                if err == errno.EAGAIN:  # Would block: try later
-                    await asyncio.sleep(0.1)
-                    continue
-                break
-            else:
-                d = d[ns:]
-                if d:
-                    await asyncio.sleep(self._tim_short)
-                    if (time.time() - start) > self._to_secs:
-                        break
-        else:
-            # The 0.2s delay is necessary otherwise messages can be lost if the
-            # app attempts to send them in quick succession. Also occurs on
-            # Pyboard D despite completely different hardware.
-            # Is it better to return immediately and delay subsequent writes?
-            # Should the delay be handled at a higher level?
-            #await asyncio.sleep(0.2)  # Disallow rapid writes: result in data loss
-            return True  # Success
-        self._close('Write fail: closing connection.')
-        return False
+        try:
+            self._swriter.write(d)
+            # Raise TimeoutError if client fails
+            await asyncio.wait_for(self._swriter.drain(), self._to_secs)
+        except (OSError, asyncio.TimeoutError):
+            self._close('Write fail: closing connection.')
+            return False
+        return True  # Success
 
     def __getitem__(self, client_id):  # Return a Connection of another client
         return Connection._conns[client_id]
 
     def _close(self, reason=''):
-        if self._sock is not None:
+        if self._swriter is not None:
             self._verbose and print('fail detected')
             self._verbose and reason and print('Reason:', reason)
-            self._sock.close()
-            self._sock = None
+            _sclose(self._swriter)
+            self._sreader = None
+            self._swriter = None
+            self._up = False
+            self._evok.clear()
+            self._evwr.clear()
+            self._evack.set()  # Wake any task awaiting an ACK
+            self._wbuf = bytearray()
+            self._evflush.set()  # Wake any writer paused by backpressure
 
 # API aliases
 client_conn = Connection.client_conn